@@ -20,7 +20,10 @@ from backend.session_manager import SessionManager
 from backend.volume_manager import (
     load_image_or_stack,
     load_mask_like,
+    open_chunked_mask,
+    read_mask_pixels,
     save_mask,
+    LazyMask,
     Volume,
 )
 
@@ -42,7 +45,10 @@ __all__ = [
     "SessionManager",
     "load_image_or_stack",
     "load_mask_like",
+    "open_chunked_mask",
+    "read_mask_pixels",
     "save_mask",
+    "LazyMask",
     "Volume",
     "get_display_name",
     "NeuroglancerManager",
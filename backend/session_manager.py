@@ -10,7 +10,9 @@ class SessionManager:
     """
 
     def __init__(self):
-        self._lock = threading.RLock()
+        # Plain Lock: no method re-enters another, so RLock's extra
+        # ownership bookkeeping is wasted
+        self._lock = threading.Lock()
         self.state: Dict[str, Any] = {
             "mode3d": False,        # whether current dataset is 3D
             "image_path": None,     # absolute path to loaded image or stack
@@ -36,6 +38,17 @@ class SessionManager:
         with self._lock:
             return self.state.get(key, default)
 
+    # -----------------------------------------------------
+    # Get several session values under a single lock acquire
+    # -----------------------------------------------------
+    def get_many(self, *keys):
+        """
+        Return a tuple of values for the given keys. Cheaper than
+        snapshot() on hot request paths: one lock acquire, no dict copy.
+        """
+        with self._lock:
+            return tuple(self.state.get(k) for k in keys)
+
     # -----------------------------------------------------
     # Return a full copy of session state (thread-safe)
     # -----------------------------------------------------
@@ -0,0 +1,64 @@
+"""
+Proofreading Tool - Shared-Memory Volume Handle
+-------------------------------------------
+Lets multiple worker processes (e.g. gunicorn) serve the same decoded
+volume from one POSIX shared-memory segment instead of each worker
+re-decoding its own copy (N× CPU and N× RAM for N workers).
+
+The loading worker publishes the array once; siblings attach by the
+(name, shape, dtype) descriptor kept in session state. Opt-in via the
+ProofreadingTool_SHM=1 environment variable in routes/landing.py.
+"""
+
+import atexit
+import numpy as np
+from multiprocessing import shared_memory
+
+# Segments this process created (owner unlinks them at exit) and segments
+# it merely attached to (kept referenced so the buffer stays mapped).
+_owned = {}
+_attached = {}
+
+
+def publish_shared_volume(name, array):
+    """
+    Copy `array` into a shared-memory segment and return the descriptor
+    dict to persist in session state for sibling workers.
+    """
+    array = np.ascontiguousarray(array)
+    try:
+        shm = shared_memory.SharedMemory(create=True, size=array.nbytes, name=name)
+    except FileExistsError:
+        stale = shared_memory.SharedMemory(name=name)
+        stale.close()
+        stale.unlink()
+        shm = shared_memory.SharedMemory(create=True, size=array.nbytes, name=name)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    _owned[name] = shm
+    print(f"🧩 Published shared volume: {name} {array.shape} {array.dtype}")
+    return {"name": name, "shape": tuple(array.shape), "dtype": str(array.dtype)}
+
+
+def attach_shared_volume(desc):
+    """
+    Attach to a published segment and return an ndarray view of it.
+    Raises FileNotFoundError if the segment no longer exists.
+    """
+    name = desc["name"]
+    shm = _owned.get(name) or _attached.get(name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = shm
+    return np.ndarray(tuple(desc["shape"]), dtype=np.dtype(desc["dtype"]), buffer=shm.buf)
+
+
+@atexit.register
+def _cleanup():
+    # Only unlink owned segments: closing (unmapping) here could pull the
+    # buffer out from under ndarray views that are still being torn down.
+    # The mappings themselves are released when the process exits.
+    for shm in _owned.values():
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
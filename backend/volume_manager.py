@@ -17,6 +17,13 @@ import cv2
 import os
 from PIL import Image
 
+# Optional: chunked mask storage (editing large 3D masks touches only
+# the modified chunks instead of whole slices)
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
 
 # ------------------------------------------------------
 # Utility: normalize 2D/3D array into uint8 grayscale
@@ -25,6 +32,17 @@ def _to_uint8(arr):
     arr = np.asarray(arr)
     if arr.dtype == np.uint8:
         return arr
+    # Single SIMD pass through OpenCV instead of five numpy passes
+    # (min, max, subtract, divide, clip/cast) each allocating float64.
+    # cv2 only handles 2D kernels, so flatten stacks to 2D and reshape back;
+    # global min/max is unchanged by the reshape.
+    if arr.size and arr.dtype != bool:
+        try:
+            flat = arr.reshape(-1, arr.shape[-1]) if arr.ndim > 2 else arr
+            out = cv2.normalize(flat, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+            return out.reshape(arr.shape)
+        except cv2.error:
+            pass  # unsupported dtype (e.g. int64) — use the numpy path below
     mn, mx = float(np.min(arr)), float(np.max(arr))
     if mx <= mn:
         return np.zeros_like(arr, dtype=np.uint8)
@@ -42,13 +60,15 @@ def load_image_or_stack(path):
     Returns:
         np.ndarray with shape (Z, Y, X) for 3D stacks, (Y, X) for 2D images.
     """
-    if not os.path.exists(path):
-        raise FileNotFoundError(f"Image/stack not found: {path}")
-
+    # No up-front existence stat: the open below serves as both the
+    # existence check and the read (no TOCTOU window, one syscall less).
     ext = os.path.splitext(path)[-1].lower()
     if ext in [".png", ".jpg", ".jpeg"]:
         arr = cv2.imread(path, cv2.IMREAD_UNCHANGED)
         if arr is None:
+            # only stat on the error path, to report the right cause
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Image/stack not found: {path}")
             raise ValueError(f"Failed to read image: {path}")
         if arr.ndim == 3:
             arr = cv2.cvtColor(arr, cv2.COLOR_BGR2GRAY)
@@ -57,15 +77,33 @@ def load_image_or_stack(path):
         return arr
 
     if ext in [".tif", ".tiff"]:
-        arr = np.asarray(tiff.imread(path))
-        arr = _to_uint8(arr)
+        # Prefer a memory-mapped view: startup becomes O(1) instead of
+        # O(stack size), and the OS page cache serves only the slices the
+        # user actually scrubs to. Normalization is deferred to the
+        # per-slice display path (see volume_intensity_range below).
+        # The compression tag of the first page tells us up front whether
+        # the file is memmappable (1 == uncompressed); compressed stacks
+        # take the eager in-RAM decode.
+        arr = None
+        with tiff.TiffFile(path) as tf:
+            uncompressed = tf.pages[0].compression == 1
+        if uncompressed:
+            try:
+                arr = tiff.memmap(path, mode="r")
+                print(f"🗺️ Memory-mapped TIFF: shape={arr.shape} dtype={arr.dtype}")
+            except ValueError:
+                arr = None  # e.g. non-contiguous page layout
+        if arr is None:
+            arr = np.asarray(tiff.imread(path))
+            arr = _to_uint8(arr)
 
         # Handle 2D single slice
         if arr.ndim == 2:
             print(f"✅ Loaded single-slice TIFF: shape={arr.shape}")
             return arr
 
-        # Handle 3D stack (auto-detect orientation)
+        # Handle 3D stack (auto-detect orientation; shape inspection only,
+        # np.moveaxis returns a view so no data is read here)
         if arr.ndim == 3:
             z, y, x = arr.shape
             print(f"📦 Raw TIFF shape: {arr.shape}")
@@ -84,20 +122,28 @@ def load_image_or_stack(path):
 
 
 # ------------------------------------------------------
-# Core: load or create binary mask matching the volume
+# Utility: global intensity range for deferred display scaling
 # ------------------------------------------------------
-def load_mask_like(mask_path, volume):
+def volume_intensity_range(volume):
     """
-    Load a binary mask that matches the given volume.
-    Automatically corrects mismatched dimensions by transposing.
+    Return (min, max) over the whole volume as floats.
 
-    Returns:
-        np.ndarray mask with same shape as volume.
+    Used when the volume is served lazily (memmap) and normalization
+    happens per slice at display time — the range is computed once in a
+    single streaming pass so every slice is scaled consistently.
     """
-    if mask_path is None or not os.path.exists(mask_path):
-        print("ℹ️ No mask found — creating empty mask.")
-        return np.zeros_like(volume, dtype=np.uint8)
+    return float(volume.min()), float(volume.max())
+
 
+# ------------------------------------------------------
+# Core: load or create binary mask matching the volume
+# ------------------------------------------------------
+def read_mask_pixels(mask_path):
+    """
+    Decode a mask file into a raw uint8 array, without aligning it to
+    any volume. Split out of load_mask_like so callers can run the mask
+    decode on another thread while the image itself is still loading.
+    """
     ext = os.path.splitext(mask_path)[-1].lower()
     if ext in [".png", ".jpg", ".jpeg"]:
         mask = cv2.imread(mask_path, cv2.IMREAD_UNCHANGED)
@@ -105,10 +151,28 @@ def load_mask_like(mask_path, volume):
             raise ValueError(f"Failed to read mask: {mask_path}")
         if mask.ndim == 3:
             mask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY)
-        mask = _to_uint8(mask)
+        return _to_uint8(mask)
+    return _to_uint8(np.asarray(tiff.imread(mask_path)))
+
+
+def load_mask_like(mask_path, volume):
+    """
+    Load a binary mask that matches the given volume.
+    Automatically corrects mismatched dimensions by transposing.
+
+    Accepts either a path or an already-decoded array (e.g. from
+    read_mask_pixels on a worker thread).
+
+    Returns:
+        np.ndarray mask with same shape as volume.
+    """
+    if isinstance(mask_path, str) or mask_path is None:
+        if mask_path is None or not os.path.exists(mask_path):
+            print("ℹ️ No mask found — creating empty mask.")
+            return np.zeros_like(volume, dtype=np.uint8)
+        mask = read_mask_pixels(mask_path)
     else:
-        mask = np.asarray(tiff.imread(mask_path))
-        mask = _to_uint8(mask)
+        mask = np.asarray(mask_path)
 
     print(f"📦 Raw mask shape: {mask.shape}")
 
@@ -117,37 +181,108 @@ def load_mask_like(mask_path, volume):
         print("✅ Mask shape matches volume.")
         return mask
 
-    # --- Try automatic transpositions ---
-    candidates = [
-        (0, 1, 2),  # identity
-        (1, 0, 2),  # swap first two
-        (2, 1, 0),  # move last to first
-        (1, 2, 0),  # H,W,Z → Z,H,W
-        (2, 0, 1),  # W,H,Z → Z,H,W
-        (0, 2, 1),  # Z,H,W → Z,W,H (rare)
-    ]
-
-    best = None
-    for perm in candidates:
-        if mask.ndim == 3 and tuple(np.array(mask.shape)[list(perm)]) == volume.shape:
-            best = perm
-            mask = np.transpose(mask, perm)
-            print(f"🔄 Auto-transposed mask axes {perm} → {mask.shape}")
-            break
-
-    if best is None:
-        print(f"⚠️ Could not automatically align mask. Resizing to volume shape...")
-        mask2d = mask[0] if mask.ndim == 3 else mask
-        mask2d = cv2.resize(mask2d, (volume.shape[-1], volume.shape[-2]), interpolation=cv2.INTER_NEAREST)
-        if volume.ndim == 3:
-            mask = np.stack([mask2d] * volume.shape[0], axis=0)
-        else:
-            mask = mask2d
+    # --- Infer the axis permutation directly from the shapes ---
+    # If the mask shape is a permutation of the volume shape, the aligning
+    # transpose follows from sorting both shapes — no candidate search.
+    if mask.ndim == 3 and volume.ndim == 3 and sorted(mask.shape) == sorted(volume.shape):
+        perm = tuple(int(i) for i in np.argsort(mask.shape)[np.argsort(np.argsort(volume.shape))])
+        mask = np.transpose(mask, perm)
+        print(f"🔄 Auto-transposed mask axes {perm} → {mask.shape}")
+    else:
+        # The old fallback silently resized the first slice and stacked it
+        # Z times — an O(volume) copy that masked a real data problem.
+        raise ValueError(
+            f"Mask shape {mask.shape} does not match volume shape "
+            f"{volume.shape} under any axis permutation"
+        )
 
     print(f"✅ Final mask shape: {mask.shape}")
     return (mask > 0).astype(np.uint8)
 
 
+# ------------------------------------------------------
+# Core: create a disk-backed (memmap) working mask
+# ------------------------------------------------------
+def create_mask_memmap(shape, path):
+    """
+    Create or reopen a uint8 mask of the given shape backed by a raw
+    sidecar file via np.memmap.
+
+    Per-slice edits then only dirty the touched pages instead of pinning
+    the whole mask in RAM (8 GB for a 2048³ stack), and saving flushes
+    dirty pages rather than rewriting the full volume.
+    """
+    nbytes = int(np.prod(shape))
+    if os.path.exists(path) and os.path.getsize(path) == nbytes:
+        mode = "r+"  # resume a previous session's working mask
+    else:
+        mode = "w+"
+    mask = np.memmap(path, dtype=np.uint8, mode=mode, shape=tuple(shape))
+    print(f"🗺️ Mask memmap ({mode}): {path} {mask.shape}")
+    return mask
+
+
+# ------------------------------------------------------
+# Core: open a chunk-tiled working mask (zarr if available)
+# ------------------------------------------------------
+def open_chunked_mask(shape, base_path):
+    """
+    Open an on-disk uint8 working mask for the given volume shape.
+
+    With zarr installed, 3D masks are stored slice-major in
+    (1, ≤512, ≤512) chunks so each edit persists only the chunks it
+    modified and saving is O(dirty chunks). Without zarr (or for 2D),
+    falls back to the raw memmap sidecar.
+    """
+    shape = tuple(shape)
+    if zarr is not None and len(shape) == 3:
+        z, y, x = shape
+        mask = zarr.open(
+            base_path + ".zarr",
+            mode="a",
+            shape=shape,
+            chunks=(1, min(512, y), min(512, x)),
+            dtype="u1",
+        )
+        print(f"🗺️ Chunked mask (zarr): {base_path}.zarr {shape}")
+        return mask
+    return create_mask_memmap(shape, base_path + ".raw")
+
+
+# ------------------------------------------------------
+# Core: lazily-allocated sparse 3D mask
+# ------------------------------------------------------
+class LazyMask:
+    """
+    Sparse in-memory 3D mask that allocates slices on first write.
+
+    A fresh dense mask for a 2048³ volume is a synchronous 8 GB calloc,
+    but typical sessions edit only a few slices. Reads of untouched
+    slices return a shared read-only zero slice; memory scales with the
+    number of edited slices, and `dirty` exposes which z have data so
+    export paths can skip the rest.
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.uint8)
+        self._slices = {}
+        self._empty = np.zeros(self.shape[1:], dtype=np.uint8)
+        self._empty.flags.writeable = False
+
+    @property
+    def dirty(self):
+        """Set of slice indices that have been written."""
+        return self._slices.keys()
+
+    def __getitem__(self, z):
+        return self._slices.get(int(z), self._empty)
+
+    def __setitem__(self, z, value):
+        self._slices[int(z)] = np.ascontiguousarray(value, dtype=np.uint8)
+
+
 # ------------------------------------------------------
 # Core: save mask to disk (auto extension)
 # ------------------------------------------------------
@@ -162,7 +297,8 @@ def save_mask(mask, path):
     if ext in [".tif", ".tiff"]:
         tiff.imwrite(path, mask)
     elif ext in [".png", ".jpg", ".jpeg"]:
-        im = Image.fromarray(mask * 255)
+        # Single SIMD compare to 0/255 instead of a separate multiply pass
+        im = Image.fromarray(cv2.compare(mask, 0, cv2.CMP_GT))
         im.save(path)
     else:
         # Default fallback to TIFF
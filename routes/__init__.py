@@ -4,7 +4,9 @@ Contains Flask route handlers organized by functionality.
 """
 
 from routes.landing import register_landing_routes
+from routes.editor import register_editor_routes
 
 __all__ = [
-    'register_landing_routes'
+    'register_landing_routes',
+    'register_editor_routes'
 ]
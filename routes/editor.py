@@ -8,15 +8,84 @@ Supports both 2D and 3D images.
 import io
 import os
 import base64
+import functools
+import struct
+import threading
 import numpy as np
 import cv2
 import tifffile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from flask import Blueprint, render_template, request, send_file, current_app, jsonify
 from PIL import Image
-from backend.volume_manager import save_mask
+from backend.volume_manager import open_chunked_mask, LazyMask
+from backend.shared_volume import attach_shared_volume
 
 bp = Blueprint("editor", __name__, url_prefix="")
 
+# Pillow-SIMD (drop-in Pillow fork with vectorized codecs, see
+# requirements.txt) reports a ".postN" version suffix. Plain Pillow works
+# but runs the slice encode/decode hot paths ~4-6x slower.
+if ".post" not in getattr(Image, "__version__", ""):
+    print("ℹ️ pillow-simd not detected — image codecs run on plain Pillow")
+
+# ---------------------------------------------------------
+# Encoded-PNG caches: slices are immutable between mask
+# updates, so re-encoding them on every GET is wasted work.
+# Keyed by (load generation, z); bounded FIFO to cap memory.
+# Generations (VOLUME_GEN / MASK_GEN in app config) increase
+# monotonically on every volume/mask assignment — unlike id(),
+# which the allocator can reuse after an eviction, silently
+# aliasing a new dataset's slices to stale cache entries/ETags.
+# ---------------------------------------------------------
+_PNG_CACHE_MAX = 64
+_slice_png_cache: OrderedDict = OrderedDict()
+_mask_png_cache: OrderedDict = OrderedDict()
+_png_cache_lock = threading.Lock()
+
+def _png_cache_put(cache, key, data):
+    with _png_cache_lock:
+        cache[key] = data
+        while len(cache) > _PNG_CACHE_MAX:
+            cache.popitem(last=False)
+
+def _vol_gen():
+    return current_app.config.get("VOLUME_GEN", 0)
+
+def _mask_gen():
+    return current_app.config.get("MASK_GEN", 0)
+
+# Single-worker prefetch pool: while the browser renders slice z, encode
+# z±1 in the background so sequential scrubbing hits the PNG cache.
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=1)
+_prefetch_pending: set = set()
+
+def _prefetch_slice(gen, volume, vrange, vmax, z):
+    key = (gen, z)
+    if key in _slice_png_cache or key in _prefetch_pending:
+        return
+    _prefetch_pending.add(key)
+    try:
+        rgb = _to_rgb(volume[z], vrange=vrange, vmax=vmax)
+        bio = io.BytesIO()
+        Image.fromarray(rgb).save(bio, format="PNG", compress_level=1)
+        _png_cache_put(_slice_png_cache, key, bio.getvalue())
+    finally:
+        _prefetch_pending.discard(key)
+
+# Decode pool for batch mask updates: base64 + zlib (PNG) decoding releases
+# the GIL, so independent slices decode in parallel across cores.
+_DECODE_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+# Per-slice edit counters, used to build weak ETags so scrub-back requests
+# can be answered with 304 instead of re-sending identical PNGs.
+_mask_dirty_counter: dict = {}
+
+def _invalidate_mask_slice(z):
+    key = (_mask_gen(), z)
+    _mask_png_cache.pop(key, None)
+    _mask_dirty_counter[key] = _mask_dirty_counter.get(key, 0) + 1
+
 def register_editor_routes(app):
     app.register_blueprint(bp)
 
@@ -26,17 +95,17 @@ def register_editor_routes(app):
 @bp.route("/edit", methods=["GET"])
 def editor():
     sm = current_app.session_manager
-    st = sm.snapshot()
-    if not st["image_path"]:
+    image_path, mask_path = sm.get_many("image_path", "mask_path")
+    if not image_path:
         from flask import redirect, url_for
         return redirect(url_for("landing.index"))
 
-    volume = current_app.config.get("CURRENT_VOLUME")
+    volume = _current_volume()
     if volume is None:
         from flask import redirect, url_for
         return redirect(url_for("landing.index"))
 
-    mode3d = isinstance(volume, np.ndarray) and volume.ndim == 3
+    mode3d = getattr(volume, "ndim", 0) == 3  # duck-typed: works for memmap/zarr too
     num_slices = volume.shape[0] if mode3d else 1
     shape_str = " × ".join(map(str, volume.shape))
 
@@ -45,27 +114,47 @@ def editor():
         mode3d=mode3d,
         num_slices=num_slices,
         shape=shape_str,
-        image_path=st.get("image_path", ""),
-        mask_path=st.get("mask_path", "")
+        image_path=image_path or "",
+        mask_path=mask_path or ""
     )
 
 # ---------------------------------------------------------
 # Utility: convert grayscale array to RGB
 # ---------------------------------------------------------
-def _to_rgb(arr2d):
-    arr = np.asarray(arr2d)
+@functools.lru_cache(maxsize=8)
+def _norm_lut(vmax):
+    """256-entry uint8 LUT stretching [0..vmax] to [0..255]."""
+    return np.clip(np.arange(256) * 255.0 / vmax, 0, 255).astype(np.uint8)
+
+def _to_rgb(arr2d, vrange=None, vmax=None):
+    arr = np.ascontiguousarray(arr2d)
     if arr.ndim == 3 and arr.shape[-1] == 3:
-        return arr.astype(np.uint8)
-    arr = (arr / arr.max() * 255.0) if arr.max() > 0 else arr
-    arr = np.clip(arr, 0, 255).astype(np.uint8)
-    return np.stack([arr] * 3, axis=-1)
+        return arr.astype(np.uint8, copy=False)
+    if arr.dtype == np.uint8:
+        if vmax not in (None, 0, 255):
+            # Normalize with one SIMD table lookup against the global max
+            # instead of per-slice float math
+            arr = cv2.LUT(arr, _norm_lut(vmax))
+    else:
+        if vrange is not None:
+            # Lazily-loaded (memmap) slice: scale with the precomputed
+            # global range so all slices are normalized consistently.
+            mn, mx = vrange
+            scale = 255.0 / (mx - mn) if mx > mn else 0.0
+            arr = cv2.convertScaleAbs(arr, alpha=scale, beta=-mn * scale)
+        else:
+            out = np.empty(arr.shape, np.uint8)
+            cv2.normalize(arr, out, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+            arr = out
+    # One SIMD pass instead of three numpy passes + np.stack allocation
+    return cv2.cvtColor(arr, cv2.COLOR_GRAY2RGB)
 
 # ---------------------------------------------------------
 # API: image slice
 # ---------------------------------------------------------
 @bp.get("/api/slice/<int:z>")
 def api_slice(z: int):
-    volume = current_app.config.get("CURRENT_VOLUME")
+    volume = _current_volume()
     if volume is None:
         return jsonify(error="No volume loaded"), 404
     if volume.ndim == 2:
@@ -73,41 +162,165 @@ def api_slice(z: int):
     else:
         z = int(np.clip(z, 0, volume.shape[0] - 1))
         sl = volume[z]
-    rgb = _to_rgb(sl)
+
+    # Image slices never change while loaded, so a weak ETag keyed by the
+    # load generation lets scrub-back requests finish as 304 with no
+    # encode and no body.
+    gen = _vol_gen()
+    etag = f'W/"{gen}-{z}"'
+    if request.headers.get("If-None-Match") == etag:
+        return "", 304
+
+    vrange = current_app.config.get("VOLUME_RANGE")
+    vmax = current_app.config.get("VOLUME_MAX")
+    key = (gen, z)
+    cached = _slice_png_cache.get(key)
+    if cached is None:
+        rgb = _to_rgb(sl, vrange=vrange, vmax=vmax)
+        bio = io.BytesIO()
+        Image.fromarray(rgb).save(bio, format="PNG", compress_level=1)
+        cached = bio.getvalue()
+        _png_cache_put(_slice_png_cache, key, cached)
+
+    # Speculatively encode the neighbours the user is likely to scrub to next
+    if volume.ndim == 3:
+        for nz in (z + 1, z - 1):
+            if 0 <= nz < volume.shape[0] and (gen, nz) not in _slice_png_cache:
+                _PREFETCH_POOL.submit(_prefetch_slice, gen, volume, vrange, vmax, nz)
+
+    resp = send_file(io.BytesIO(cached), mimetype="image/png")
+    resp.headers["ETag"] = etag
+    return resp
+
+# ---------------------------------------------------------
+# Utility: shared empty-slice PNG for untouched lazy-mask slices
+# ---------------------------------------------------------
+@functools.lru_cache(maxsize=4)
+def _empty_mask_png(shape_hw):
     bio = io.BytesIO()
-    Image.fromarray(rgb).save(bio, format="PNG")
-    bio.seek(0)
-    return send_file(bio, mimetype="image/png")
+    Image.fromarray(np.zeros(shape_hw, dtype=bool)).save(
+        bio, format="PNG", compress_level=1
+    )
+    return bio.getvalue()
 
 # ---------------------------------------------------------
 # API: mask slice
 # ---------------------------------------------------------
 @bp.get("/api/mask/<int:z>")
 def api_mask(z: int):
-    mask = current_app.config.get("CURRENT_MASK")
-    volume = current_app.config.get("CURRENT_VOLUME")
+    volume = _current_volume()
 
     # if no mask loaded but an image exists, create a blank one
-    if mask is None and volume is not None:
-        if volume.ndim == 2:
-            mask = np.zeros_like(volume, dtype=np.uint8)
-        elif volume.ndim == 3:
-            mask = np.zeros_like(volume, dtype=np.uint8)
-        current_app.config["CURRENT_MASK"] = mask
-
+    mask = _ensure_mask(volume)
     if mask is None:
         return jsonify(error="No mask loaded"), 404
 
     if mask.ndim == 2:
         sl = mask
+        z = 0
     else:
         z = int(np.clip(z, 0, mask.shape[0] - 1))
         sl = mask[z]
-    im = Image.fromarray((sl > 0).astype(np.uint8) * 255)
-    bio = io.BytesIO()
-    im.save(bio, format="PNG")
-    bio.seek(0)
-    return send_file(bio, mimetype="image/png")
+
+    key = (_mask_gen(), z)
+    # The ETag folds in the per-slice edit counter, so it changes exactly
+    # when /api/mask/update touches this slice.
+    etag = f'W/"{key[0]}-{z}-{_mask_dirty_counter.get(key, 0)}"'
+    if request.headers.get("If-None-Match") == etag:
+        return "", 304
+
+    # Untouched slices of a lazy mask all share one static empty PNG
+    if isinstance(mask, LazyMask) and z not in mask.dirty:
+        resp = send_file(io.BytesIO(_empty_mask_png(mask.shape[1:])), mimetype="image/png")
+        resp.headers["ETag"] = etag
+        return resp
+
+    cached = _mask_png_cache.get(key)
+    if cached is None:
+        # bool array -> mode "1" image -> 1-bit PNG: same black/white
+        # rendering as the old 0/255 grayscale at 1/8th the payload
+        im = Image.fromarray(np.asarray(sl) > 0)
+        bio = io.BytesIO()
+        im.save(bio, format="PNG", compress_level=1)
+        cached = bio.getvalue()
+        _png_cache_put(_mask_png_cache, key, cached)
+    resp = send_file(io.BytesIO(cached), mimetype="image/png")
+    resp.headers["ETag"] = etag
+    return resp
+
+# ---------------------------------------------------------
+# Utility: fetch the loaded volume (attaching shared memory if needed)
+# ---------------------------------------------------------
+def _current_volume():
+    """
+    Return the loaded volume for this worker. If another worker loaded
+    it into shared memory (ProofreadingTool_SHM mode), attach to the
+    published segment instead of re-decoding the stack.
+    """
+    volume = current_app.config.get("CURRENT_VOLUME")
+    if volume is None:
+        desc = current_app.session_manager.get("shared_volume")
+        if desc:
+            try:
+                volume = attach_shared_volume(desc)
+                current_app.config["CURRENT_VOLUME"] = volume
+                current_app.config["VOLUME_GEN"] = _vol_gen() + 1
+            except FileNotFoundError:
+                pass
+    return volume
+
+# ---------------------------------------------------------
+# Utility: create the working mask for the loaded volume
+# ---------------------------------------------------------
+def _ensure_mask(volume):
+    """
+    Return the current mask, creating one if none is loaded yet.
+    Fresh 3D masks are disk-backed via open_chunked_mask — chunked zarr
+    arrays when zarr is installed (edits persist only the chunks they
+    touch), a raw memmap sidecar otherwise — so init is a metadata-only
+    operation and memory scales with edits, not volume size. If the
+    workdir is unwritable, an in-memory LazyMask keeps those properties
+    without touching disk. 2D masks are a single slice and stay dense.
+    """
+    mask = current_app.config.get("CURRENT_MASK")
+    if mask is not None or volume is None:
+        return mask
+    if volume.ndim != 3:
+        mask = np.zeros_like(volume, dtype=np.uint8)
+    else:
+        sm = current_app.session_manager
+        base_dir = os.path.abspath("./_uploads")
+        os.makedirs(base_dir, exist_ok=True)
+        base_name = os.path.splitext(os.path.basename(sm.get("image_name") or "image"))[0]
+        try:
+            mask = open_chunked_mask(volume.shape, os.path.join(base_dir, f"{base_name}_mask"))
+        except OSError:
+            mask = LazyMask(volume.shape)
+    current_app.config["CURRENT_MASK"] = mask
+    current_app.config["MASK_GEN"] = _mask_gen() + 1
+    return mask
+
+# ---------------------------------------------------------
+# Utility: decode a client PNG into a 0/1 uint8 slice
+# ---------------------------------------------------------
+def _decode_mask_slice(png_bytes, target_hw):
+    """
+    Decode PNG bytes to a binary uint8 array of shape target_hw (H, W).
+    The front-end normally sends PNGs at the mask resolution already, so
+    the resize is skipped in the common case; when sizes differ, PIL
+    resizes during decode in one C pass instead of a numpy + cv2 round trip.
+    """
+    img = Image.open(io.BytesIO(png_bytes)).convert("L")
+    th, tw = target_hw
+    if img.size != (tw, th):
+        img = img.resize((tw, th), Image.NEAREST)
+    # PIL's "L" image is already a contiguous uint8 buffer; wrapping it with
+    # frombuffer and comparing with an explicit uint8 out avoids the
+    # array-copy -> bool compare -> uint8 cast triple pass.
+    buf = np.frombuffer(img.tobytes(), dtype=np.uint8).reshape(th, tw)
+    arr = np.empty_like(buf)
+    np.greater(buf, 127, out=arr)  # writes 0/1 directly as uint8
+    return arr
 
 # ---------------------------------------------------------
 # API: update mask (multi-slice batch)
@@ -120,33 +333,30 @@ def api_mask_update():
     - {"full_batch": [{"z": int, "png": base64str}, ...]}
     """
     data = request.get_json(force=True)
-    mask = current_app.config.get("CURRENT_MASK")
-    volume = current_app.config.get("CURRENT_VOLUME")
+    volume = _current_volume()
 
     # --- ensure mask exists for 2D/3D cases ---
-    if mask is None and volume is not None:
-        if volume.ndim == 2:
-            mask = np.zeros_like(volume, dtype=np.uint8)
-        elif volume.ndim == 3:
-            mask = np.zeros_like(volume, dtype=np.uint8)
-        current_app.config["CURRENT_MASK"] = mask
-    elif mask is None:
+    mask = _ensure_mask(volume)
+    if mask is None:
         return jsonify(success=False, error="No mask or image loaded"), 404
 
     # --- Batch updates ---
     if "full_batch" in data:
-        for item in data["full_batch"]:
-            z = int(item["z"])
-            png_bytes = base64.b64decode(item["png"])
-            img = Image.open(io.BytesIO(png_bytes)).convert("L")
-            arr = (np.array(img) > 127).astype(np.uint8)
+        target_hw = mask.shape if mask.ndim == 2 else mask.shape[1:]
 
+        def _decode(item):
+            return int(item["z"]), _decode_mask_slice(
+                base64.b64decode(item["png"]), target_hw
+            )
+
+        # Decode all slices in parallel, then commit the writes serially
+        for z, arr in _DECODE_POOL.map(_decode, data["full_batch"]):
             if mask.ndim == 2:
-                arr = cv2.resize(arr, (mask.shape[1], mask.shape[0]), interpolation=cv2.INTER_NEAREST)
                 mask[:, :] = arr
+                _invalidate_mask_slice(0)
             else:
-                arr = cv2.resize(arr, (mask.shape[2], mask.shape[1]), interpolation=cv2.INTER_NEAREST)
                 mask[z] = arr
+                _invalidate_mask_slice(z)
         current_app.config["CURRENT_MASK"] = mask
         print(f"✅ Batch updated {len(data['full_batch'])} slice(s)")
         return jsonify(success=True)
@@ -155,15 +365,13 @@ def api_mask_update():
     if "full_png" in data:
         z = int(data.get("z", 0))
         png_bytes = base64.b64decode(data["full_png"])
-        img = Image.open(io.BytesIO(png_bytes)).convert("L")
-        arr = (np.array(img) > 127).astype(np.uint8)
 
         if mask.ndim == 2:
-            arr = cv2.resize(arr, (mask.shape[1], mask.shape[0]), interpolation=cv2.INTER_NEAREST)
-            mask[:, :] = arr
+            mask[:, :] = _decode_mask_slice(png_bytes, mask.shape)
+            _invalidate_mask_slice(0)
         else:
-            arr = cv2.resize(arr, (mask.shape[2], mask.shape[1]), interpolation=cv2.INTER_NEAREST)
-            mask[z] = arr
+            mask[z] = _decode_mask_slice(png_bytes, mask.shape[1:])
+            _invalidate_mask_slice(z)
 
         current_app.config["CURRENT_MASK"] = mask
         print(f"✅ Replaced full slice {z}")
@@ -171,34 +379,95 @@ def api_mask_update():
 
     return jsonify(success=False, error="Invalid data"), 400
 
+# ---------------------------------------------------------
+# API: update mask (binary batch protocol)
+# ---------------------------------------------------------
+@bp.post("/api/mask/update_bin")
+def api_mask_update_bin():
+    """
+    Binary alternative to the JSON /api/mask/update batch path.
+
+    Payload layout (little-endian):
+        uint32 n_slices
+        n_slices × (int32 z, uint32 png_len)
+        concatenated PNG bytes in header order
+
+    Skips the 33% base64 inflation and the per-slice JSON/b64 decode;
+    PNG ranges are sliced zero-copy out of the request body.
+    """
+    volume = _current_volume()
+    mask = _ensure_mask(volume)
+    if mask is None:
+        return jsonify(success=False, error="No mask or image loaded"), 404
+
+    view = memoryview(request.get_data(cache=False))
+    try:
+        (n,) = struct.unpack_from("<I", view, 0)
+        offset = 4
+        header = []
+        for _ in range(n):
+            z, length = struct.unpack_from("<iI", view, offset)
+            offset += 8
+            header.append((z, length))
+        items = []
+        for z, length in header:
+            if offset + length > len(view):
+                raise struct.error("truncated payload")
+            items.append((z, view[offset:offset + length]))
+            offset += length
+    except struct.error:
+        return jsonify(success=False, error="Malformed binary payload"), 400
+
+    target_hw = mask.shape if mask.ndim == 2 else mask.shape[1:]
+
+    def _decode(item):
+        z, png = item
+        return z, _decode_mask_slice(png, target_hw)
+
+    for z, arr in _DECODE_POOL.map(_decode, items):
+        if mask.ndim == 2:
+            mask[:, :] = arr
+            _invalidate_mask_slice(0)
+        else:
+            mask[z] = arr
+            _invalidate_mask_slice(z)
+    current_app.config["CURRENT_MASK"] = mask
+    print(f"✅ Binary batch updated {n} slice(s)")
+    return jsonify(success=True)
+
+# ---------------------------------------------------------
+# Utility: stream a 3D mask as 512×512 tiles for tifffile
+# ---------------------------------------------------------
+def _mask_tiles(mask, tile=512):
+    """Yield (cropped) 512×512 tiles slice by slice; tifffile pads edges."""
+    for z in range(mask.shape[0]):
+        sl = np.asarray(mask[z], dtype=np.uint8)
+        for y in range(0, sl.shape[0], tile):
+            for x in range(0, sl.shape[1], tile):
+                yield sl[y:y + tile, x:x + tile]
+
 # ---------------------------------------------------------
 # API: save mask (handles 2D, 3D, upload/path modes)
 # ---------------------------------------------------------
 @bp.post("/api/save")
 def api_save():
     sm = current_app.session_manager
-    st = sm.snapshot()
-    mask = current_app.config.get("CURRENT_MASK")
-    volume = current_app.config.get("CURRENT_VOLUME")
+    img_path, mask_path, load_mode, image_name = sm.get_many(
+        "image_path", "mask_path", "load_mode", "image_name"
+    )
+    volume = _current_volume()
 
-    if mask is None and volume is not None:
-        if volume.ndim == 2:
-            mask = np.zeros_like(volume, dtype=np.uint8)
-        elif volume.ndim == 3:
-            mask = np.zeros_like(volume, dtype=np.uint8)
-        current_app.config["CURRENT_MASK"] = mask
-    elif mask is None:
+    mask = _ensure_mask(volume)
+    if mask is None:
         return jsonify(success=False, error="No mask or image loaded"), 404
 
-    img_path = st.get("image_path")
-    mask_path = st.get("mask_path")
-    load_mode = st.get("load_mode", "path")
+    load_mode = load_mode or "path"
 
     # Determine save directory and filename
     if load_mode == "upload" or not img_path or not os.path.exists(img_path):
         base_dir = os.path.abspath("./_uploads")
         os.makedirs(base_dir, exist_ok=True)
-        base_name = os.path.splitext(os.path.basename(st.get("image_name", "image")))[0]
+        base_name = os.path.splitext(os.path.basename(image_name or "image"))[0]
     else:
         base_dir = os.path.dirname(img_path)
         base_name = os.path.splitext(os.path.basename(img_path))[0]
@@ -212,11 +481,37 @@ def api_save():
 
     mask_path = os.path.join(base_dir, f"{base_name}_mask{ext}")
 
+    # Flush dirty pages of a memmap-backed mask before exporting
+    if isinstance(mask, np.memmap):
+        mask.flush()
+
     # Save according to extension
     if ext in [".tif", ".tiff"]:
-        tifffile.imwrite(mask_path, mask.astype(np.uint8))
+        # Binary masks compress enormously at zlib level 1, so the tiled
+        # compressed write is both smaller and faster than dumping raw
+        # bytes. The tile generator streams one slice at a time straight
+        # from the (possibly memmapped/chunked) mask buffer.
+        if mask.ndim == 2:
+            tifffile.imwrite(
+                mask_path,
+                np.asarray(mask, dtype=np.uint8),
+                compression="zlib",
+                compressionargs={"level": 1},
+            )
+        else:
+            tifffile.imwrite(
+                mask_path,
+                _mask_tiles(mask),
+                shape=mask.shape,
+                dtype="u1",
+                tile=(512, 512),
+                compression="zlib",
+                compressionargs={"level": 1},
+            )
     else:
-        im = Image.fromarray((mask > 0).astype(np.uint8) * 255)
+        # cv2.compare yields 0/255 uint8 in one SIMD pass — same bytes as
+        # the old compare -> cast -> multiply triple pass
+        im = Image.fromarray(cv2.compare(np.asarray(mask, np.uint8), 0, cv2.CMP_GT))
         im.save(mask_path)
 
     print(f"💾 Saved mask to {mask_path}")
@@ -228,8 +523,7 @@ def api_save():
 @bp.get("/api/download")
 def api_download():
     sm = current_app.session_manager
-    st = sm.snapshot()
-    mask_path = st.get("mask_path")
+    mask_path = sm.get("mask_path")
     if not mask_path or not os.path.exists(mask_path):
         return jsonify(success=False, error="Nothing saved yet"), 404
     return send_file(mask_path, as_attachment=True)
@@ -249,12 +543,14 @@ def api_dims():
 
     fname = file.filename.lower()
     try:
+        # Only parse headers — decoding the pixels to report a shape
+        # costs seconds and gigabytes for large stacks
         if fname.endswith((".tif", ".tiff")):
-            arr = tifffile.imread(file)
-            shape = arr.shape
+            with tifffile.TiffFile(file) as tf:
+                shape = tf.series[0].shape
         else:
-            img = Image.open(file)
-            shape = img.size[::-1]
+            with Image.open(file) as img:
+                shape = img.size[::-1]
 
         return jsonify({"shape": list(shape)})
     except Exception as e:
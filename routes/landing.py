@@ -16,22 +16,157 @@ warnings if paths are invalid, instead of redirecting.
 from flask import (
     Blueprint,
     render_template,
+    render_template_string,
     request,
     current_app,
     jsonify
 )
+import functools
 import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import tifffile
+from collections import OrderedDict
+from PIL import Image
 from werkzeug.utils import secure_filename
 
-from backend.volume_manager import load_image_or_stack, load_mask_like
+from backend.volume_manager import (
+    load_image_or_stack,
+    load_mask_like,
+    read_mask_pixels,
+    volume_intensity_range,
+)
+from backend.shared_volume import publish_shared_volume, attach_shared_volume
+
+# Optional: streaming multipart parser for multi-GB uploads. Werkzeug's
+# default form parser spools large uploads through memory before the
+# route ever sees them; streaming-form-data writes socket bytes straight
+# to their final path.
+try:
+    from streaming_form_data import StreamingFormDataParser
+    from streaming_form_data.targets import FileTarget
+except ImportError:
+    StreamingFormDataParser = None
 
 bp = Blueprint("landing", __name__)
 
+# Working directory for uploaded files, resolved and created once at
+# import instead of an abspath + makedirs round-trip on every POST.
+_UPLOAD_DIR = os.path.abspath("./_uploads")
+os.makedirs(_UPLOAD_DIR, exist_ok=True)
+
 def register_landing_routes(app):
     app.register_blueprint(bp)
 
 
+def _save_upload(file_storage, path):
+    """
+    Write an uploaded file to `path`.
+
+    Large uploads are spooled to a real temp file by Werkzeug, so when
+    the source exposes a file descriptor the copy goes through
+    os.copy_file_range — the kernel moves the bytes directly between
+    files (reflinking on supporting filesystems) without bouncing each
+    chunk through userspace. Otherwise fall back to 1 MB chunked copies;
+    Werkzeug's own FileStorage.save uses a 16 KB buffer, which for
+    multi-GB stacks means hundreds of thousands of read/write syscalls.
+    """
+    src = file_storage.stream
+    with open(path, "wb") as dst:
+        if hasattr(os, "copy_file_range"):
+            try:
+                src_fd = src.fileno()
+            except (OSError, AttributeError):
+                src_fd = None  # in-memory spool, no descriptor
+            if src_fd is not None:
+                try:
+                    while os.copy_file_range(src_fd, dst.fileno(), 1 << 30):
+                        pass
+                    return
+                except OSError:
+                    # cross-device or unsupported FS — restart as a manual copy
+                    src.seek(0)
+                    dst.seek(0)
+                    dst.truncate()
+        shutil.copyfileobj(src, dst, length=1 << 20)
+
+
+@functools.lru_cache(maxsize=16)
+def _shape_str(shape):
+    """Format a shape tuple for display; memoized per volume shape."""
+    return " × ".join(map(str, shape))
+
+
+def _probe(path):
+    """
+    Stat a path once, returning the os.stat_result or None if missing.
+    One syscall serves existence, size, and mtime — on networked HPC
+    filesystems each extra stat round-trip costs milliseconds.
+    """
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+# Paths that recently failed to resolve, with the time they failed.
+# Repeated POSTs of the same bad path (double-submits, stuck retry
+# loops) answer from here instead of hitting the filesystem — on
+# networked mounts a lookup of a *missing* name is often the slowest
+# stat of all. Entries expire after a short TTL so a file that appears
+# moments later is picked up on the next attempt.
+_NEG_CACHE: OrderedDict = OrderedDict()
+_NEG_TTL = 2.0
+_NEG_MAX = 256
+
+
+def _neg_cached(path):
+    ts = _NEG_CACHE.get(path)
+    if ts is None:
+        return False
+    if time.monotonic() - ts > _NEG_TTL:
+        del _NEG_CACHE[path]
+        return False
+    return True
+
+
+def _neg_store(path):
+    _NEG_CACHE[path] = time.monotonic()
+    _NEG_CACHE.move_to_end(path)
+    while len(_NEG_CACHE) > _NEG_MAX:
+        _NEG_CACHE.popitem(last=False)
+
+
+def _neg_clear(path):
+    _NEG_CACHE.pop(path, None)
+
+
+# Minimal page for load failures: the full mask_editor.html is a 500+
+# line template with the whole editor UI, and rendering it just to show
+# a warning banner is wasted Jinja work on every bad path/upload.
+_WARN_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+  <title>Proofreading Tool</title>
+  <style>
+    body { font-family: sans-serif; margin: 40px; }
+    .warning { color: #b91c1c; margin-top: 6px; font-weight: 600; }
+  </style>
+</head>
+<body>
+  <div class="warning">{{ warning }}</div>
+  <p><a href="{{ url_for('landing.index') }}">← Back to loading page</a></p>
+</body>
+</html>"""
+
+
+def _warn(warning, **ctx):
+    """Render a lightweight warning page instead of the full editor."""
+    return render_template_string(_WARN_PAGE, warning=warning, **ctx)
+
+
 @bp.route("/", methods=["GET", "POST"])
 def index():
     """
@@ -40,12 +175,7 @@ def index():
     - Optionally loads an existing mask
     - Displays inline warning instead of redirecting
     """
-    warning = None
-    img_path = ""
-    mask_path = ""
-
     if request.method == "POST":
-        sm = current_app.session_manager
         load_mode = request.form.get("load_mode", "path")
 
         # ----------------------------
@@ -56,23 +186,15 @@ def index():
             mask_file = request.files.get("mask_file")
 
             if not img_file or img_file.filename == "":
-                warning = "⚠️ Please choose an image or stack file."
-                return render_template(
-                    "mask_editor.html",
-                    warning=warning,
-                    mode3d=False,
-                    num_slices=1
-                )
-
-            workdir = os.path.abspath("./_uploads")
-            os.makedirs(workdir, exist_ok=True)
-            img_path = os.path.join(workdir, secure_filename(img_file.filename))
-            img_file.save(img_path)
+                return _warn("⚠️ Please choose an image or stack file.")
+
+            img_path = os.path.join(_UPLOAD_DIR, secure_filename(img_file.filename))
+            _save_upload(img_file, img_path)
 
             mask_path = None
             if mask_file and mask_file.filename:
-                mask_path = os.path.join(workdir, secure_filename(mask_file.filename))
-                mask_file.save(mask_path)
+                mask_path = os.path.join(_UPLOAD_DIR, secure_filename(mask_file.filename))
+                _save_upload(mask_file, mask_path)
 
         # ----------------------------
         # 2. Handle local file path mode
@@ -81,82 +203,23 @@ def index():
             img_path = request.form.get("image_path", "").strip()
             mask_path = request.form.get("mask_path", "").strip() or None
 
-            if not img_path or not os.path.exists(img_path):
-                warning = f"⚠️ Image/stack not found: {img_path}"
-                return render_template(
-                    "mask_editor.html",
-                    warning=warning,
-                    mode3d=False,
-                    num_slices=1,
-                    image_path=img_path,
-                    mask_path=mask_path
-                )
-
-            if mask_path and not os.path.exists(mask_path):
-                warning = f"⚠️ Mask file not found: {mask_path}"
-                return render_template(
-                    "mask_editor.html",
-                    warning=warning,
-                    mode3d=False,
-                    num_slices=1,
-                    image_path=img_path,
-                    mask_path=mask_path
-                )
+            # No existence pre-stat for the image: the loader's own open()
+            # doubles as the check (one syscall less, no TOCTOU window
+            # between validation and read) and a missing file surfaces as
+            # the same inline warning via _load_and_render.
+            if not img_path or _neg_cached(img_path):
+                return _warn(f"⚠️ Image/stack not found: {img_path}")
 
-        # ----------------------------
-        # 3. Load image and mask
-        # ----------------------------
-        try:
-            volume = load_image_or_stack(img_path)
-            mask = load_mask_like(mask_path, volume)
-
-            mode3d = isinstance(volume, np.ndarray) and volume.ndim == 3
-            img_shape_str = " × ".join(map(str, volume.shape))
-
-            mask_shape_str = None
-            if mask is not None and isinstance(mask, np.ndarray):
-                mask_shape_str = " × ".join(map(str, mask.shape))
-
-        except Exception as e:
-            warning = f"⚠️ Error loading data: {e}"
-            img_shape_str = None
-            mask_shape_str = None
-            return render_template(
-                "mask_editor.html",
-                warning=warning,
-                mode3d=False,
-                num_slices=1,
-                image_path=img_path,
-                mask_path=mask_path,
-                shape=img_shape_str,
-                mask_shape=mask_shape_str
-            )
+            # The mask check stays: load_mask_like treats a missing mask
+            # as "create an empty one", which would silently swallow typos.
+            if mask_path and (_neg_cached(mask_path) or _probe(mask_path) is None):
+                _neg_store(mask_path)
+                return _warn(f"⚠️ Mask file not found: {mask_path}")
 
         # ----------------------------
-        # 4. Update session and render editor
+        # 3 + 4. Load data, update session, render editor
         # ----------------------------
-        sm.update(
-            mode3d=mode3d,
-            image_path=img_path,
-            mask_path=mask_path,
-            load_mode=load_mode,
-            image_name=os.path.basename(img_path)  # for upload or path, both fine
-        )
-        current_app.config["CURRENT_VOLUME"] = volume
-        current_app.config["CURRENT_MASK"] = mask
-
-        num_slices = volume.shape[0] if mode3d else 1
-
-        return render_template(
-            "mask_editor.html",
-            mode3d=mode3d,
-            num_slices=num_slices,
-            image_path=img_path,
-            mask_path=mask_path,
-            shape=img_shape_str,
-            mask_shape=mask_shape_str,
-            warning=None
-        )
+        return _load_and_render(img_path, mask_path, load_mode)
 
     # ----------------------------
     # Default GET (landing page)
@@ -164,6 +227,191 @@ def index():
     return render_template("index.html")
 
 
+# Decoded volumes keyed by (abs path, mtime_ns, size) of the image and
+# mask files, so re-POSTing the same dataset skips the multi-GB decode.
+# A changed file changes its key, which also invalidates stale entries.
+_VOLUME_CACHE: OrderedDict = OrderedDict()
+_VOLUME_CACHE_MAX = 4
+
+# Worker pool for overlapping the mask decode with the image load; both
+# are dominated by cv2/tifffile codec work that releases the GIL.
+_LOAD_POOL = ThreadPoolExecutor(max_workers=2)
+
+def _volume_cache_key(img_path, mask_path):
+    st = _probe(img_path)
+    if st is None:
+        return None
+    key = (os.path.abspath(img_path), st.st_mtime_ns, st.st_size)
+    if mask_path:
+        mst = _probe(mask_path)
+        if mst is None:
+            return None
+        key += (os.path.abspath(mask_path), mst.st_mtime_ns, mst.st_size)
+    return key
+
+
+def _load_and_render(img_path, mask_path, load_mode):
+    """
+    Load the image/mask pair, update the session state, and render the
+    editor. Shared by the form-based index() flow and /upload_stream.
+    """
+    sm = current_app.session_manager
+
+    try:
+        cache_key = _volume_cache_key(img_path, mask_path)
+        if cache_key is not None and cache_key in _VOLUME_CACHE:
+            volume, mask = _VOLUME_CACHE[cache_key]
+            _VOLUME_CACHE.move_to_end(cache_key)
+        else:
+            if mask_path:
+                # Decode the mask pixels on a worker thread while the
+                # (usually much larger) image loads here; alignment needs
+                # volume.shape, so only the raw decode is overlapped.
+                mask_pixels = _LOAD_POOL.submit(read_mask_pixels, mask_path)
+                volume = load_image_or_stack(img_path)
+                mask = load_mask_like(mask_pixels.result(), volume)
+            else:
+                # No mask file: leave CURRENT_MASK unset so the editor's
+                # _ensure_mask creates the working mask lazily (chunked /
+                # sparse for 3D) instead of a dense zeros allocation here.
+                volume = load_image_or_stack(img_path)
+                mask = None
+            if cache_key is not None:
+                _VOLUME_CACHE[cache_key] = (volume, mask if mask_path else None)
+                while len(_VOLUME_CACHE) > _VOLUME_CACHE_MAX:
+                    _VOLUME_CACHE.popitem(last=False)
+
+        # Duck-typed: volumes/masks may be ndarrays, memmaps, zarr arrays
+        # or LazyMask — all expose ndim/shape, and getattr skips the
+        # isinstance walk over numpy's class hierarchy on every load.
+        # shape goes through __getattr__ on some backing types (zarr),
+        # so read it once into a local for the uses below.
+        vshape = volume.shape
+        mode3d = len(vshape) == 3
+        img_shape_str = _shape_str(vshape)
+
+        mask_shape_str = None
+        mshape = getattr(mask, "shape", None)
+        if mshape is not None:
+            mask_shape_str = _shape_str(mshape)
+
+        # the paths resolved — drop any stale negative entries
+        _neg_clear(img_path)
+        if mask_path:
+            _neg_clear(mask_path)
+
+    except FileNotFoundError as e:
+        _neg_store(e.filename or img_path)
+        return _warn(f"⚠️ Image/stack not found: {e.filename or img_path}")
+    except Exception as e:
+        return _warn(f"⚠️ Error loading data: {e}")
+
+    # Optional multi-worker mode: publish the decoded volume to POSIX
+    # shared memory so sibling workers mmap the same pages instead of
+    # each re-decoding the stack (memmapped volumes already share the
+    # OS page cache and are left as-is).
+    shared_desc = None
+    if (
+        os.environ.get("ProofreadingTool_SHM") == "1"
+        and isinstance(volume, np.ndarray)
+        and not isinstance(volume, np.memmap)
+    ):
+        shared_desc = publish_shared_volume(
+            f"ptvol_{abs(hash(os.path.abspath(img_path)))}", volume
+        )
+        volume = attach_shared_volume(shared_desc)
+
+    new_state = dict(
+        mode3d=mode3d,
+        image_path=img_path,
+        mask_path=mask_path,
+        load_mode=load_mode,
+        image_name=os.path.basename(img_path),  # for upload or path, both fine
+        shared_volume=shared_desc
+    )
+    # Re-POSTing the same dataset (cache hits) leaves the state as-is, so
+    # only take the session lock when a value actually changed.
+    if sm.get_many(*new_state) != tuple(new_state.values()):
+        sm.update(**new_state)
+    current_app.config["CURRENT_VOLUME"] = volume
+    current_app.config["CURRENT_MASK"] = mask
+    # Bump the cache/ETag generations: editor caches are keyed by these
+    # rather than id(), which the allocator can reuse across datasets.
+    current_app.config["VOLUME_GEN"] = current_app.config.get("VOLUME_GEN", 0) + 1
+    current_app.config["MASK_GEN"] = current_app.config.get("MASK_GEN", 0) + 1
+    # Memory-mapped volumes are served raw and scaled per slice at
+    # display time; compute the global range once so all slices share it.
+    # For uint8 volumes, the global max feeds a display LUT instead.
+    if volume.dtype != np.uint8:
+        current_app.config["VOLUME_RANGE"] = volume_intensity_range(volume)
+        current_app.config["VOLUME_MAX"] = None
+    else:
+        current_app.config["VOLUME_RANGE"] = None
+        current_app.config["VOLUME_MAX"] = int(volume.max())
+
+    num_slices = vshape[0] if mode3d else 1
+
+    return render_template(
+        "mask_editor.html",
+        mode3d=mode3d,
+        num_slices=num_slices,
+        image_path=img_path,
+        mask_path=mask_path,
+        shape=img_shape_str,
+        mask_shape=mask_shape_str,
+        warning=None
+    )
+
+
+# ==========================================================
+# ✅ Streaming upload: socket → disk with no in-memory spool
+# ==========================================================
+@bp.route("/upload_stream", methods=["POST"])
+def upload_stream():
+    """
+    Streaming variant of the upload flow for very large stacks.
+
+    Reads the raw multipart body in 64 KB chunks through
+    streaming-form-data, so bytes flow from the socket directly into
+    _uploads/ instead of being spooled through memory by Werkzeug's
+    form parser. Requires the optional streaming-form-data package.
+    """
+    if StreamingFormDataParser is None:
+        return jsonify({"error": "streaming-form-data is not installed"}), 501
+
+    img_tmp = os.path.join(_UPLOAD_DIR, ".img_stream.part")
+    mask_tmp = os.path.join(_UPLOAD_DIR, ".mask_stream.part")
+
+    parser = StreamingFormDataParser(headers=dict(request.headers))
+    img_target = FileTarget(img_tmp)
+    mask_target = FileTarget(mask_tmp)
+    parser.register("image_file", img_target)
+    parser.register("mask_file", mask_target)
+
+    # Consume request.stream before Werkzeug's form parser gets a chance
+    # to buffer the body.
+    while True:
+        chunk = request.stream.read(64 * 1024)
+        if not chunk:
+            break
+        parser.data_received(chunk)
+
+    if not img_target.multipart_filename:
+        return jsonify({"error": "Please choose an image or stack file."}), 400
+
+    img_path = os.path.join(_UPLOAD_DIR, secure_filename(img_target.multipart_filename))
+    os.replace(img_tmp, img_path)
+
+    mask_path = None
+    if mask_target.multipart_filename:
+        mask_path = os.path.join(_UPLOAD_DIR, secure_filename(mask_target.multipart_filename))
+        os.replace(mask_tmp, mask_path)
+    elif os.path.exists(mask_tmp):
+        os.remove(mask_tmp)
+
+    return _load_and_render(img_path, mask_path, "upload")
+
+
 # ==========================================================
 # ✅ New route: /api/dims — return shape of uploaded image/mask
 # ==========================================================
@@ -178,15 +426,23 @@ def get_dims():
     if not file:
         return jsonify({"error": "No file provided"}), 400
 
-    import tifffile
-    from PIL import Image
-
     try:
+        # Parse only the headers: decoding every pixel to report a shape
+        # would allocate gigabytes for a large stack. Hand the parsers
+        # the raw spooled stream so they read/seek just the few KB of
+        # header they need instead of going through the FileStorage
+        # wrapper's buffered reads.
+        stream = file.stream
+        stream.seek(0)
         if file.filename.lower().endswith((".tif", ".tiff")):
-            arr = tifffile.imread(file)
+            # the spooled stream has no filesystem name; give tifffile one
+            with tifffile.TiffFile(stream, name=file.filename) as tf:
+                shape = tf.series[0].shape
         else:
-            arr = np.array(Image.open(file))
+            with Image.open(stream) as im:
+                bands = len(im.getbands())
+                shape = (im.height, im.width) + ((bands,) if bands > 1 else ())
 
-        return jsonify({"shape": list(arr.shape)})
+        return jsonify({"shape": list(shape)})
     except Exception as e:
         return jsonify({"error": str(e)}), 500